@@ -15,15 +15,24 @@ from joblib.parallel import Parallel, delayed
 from tqdm import tqdm
 
 # Import whatever else is needed
+from collections import deque
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from functools import partial
+import glob
+import hashlib
 import itertools as it
 import numpy as np
 import operator as op
 import pickle
 from PIL import Image
-from scipy.interpolate import interp1d
-import sklearn.metrics as skmetrics
-
-from data.sets import MOBIUS, SMD, SLD
+import tempfile
+import threading
+try:
+	import numba
+except ImportError:
+	numba = None  # The segmentation metrics will fall back to the NumPy implementation
+
+from data.sets import IMG_EXTS, MOBIUS, SMD, SLD
 from evaluation.segmentation import *
 from models.descriptor_models import DescriptorModel
 #from models.keras_models import KerasModel
@@ -33,6 +42,9 @@ from models.descriptor_models import DescriptorModel
 TRAIN_DATASETS = 'All', 'MASD+SBVPI', 'MASD+SMD', 'SBVPI', 'SMD'
 TEST_DATASETS = {ds.__name__: ds for ds in (MOBIUS, SLD, SMD)}
 REC_SIZE = 400, 400  # Size for recognition models
+GREY_LEVELS = 256  # Number of distinct values in (8-bit) greyscale predictions
+SEG_BATCH = 16  # Number of samples to compute segmentation metrics for at once
+TQDM_JOBLIB_LOCK = threading.Lock()  # tqdm_joblib patches joblib globally, so concurrent configurations have to take turns using it
 
 
 class Main:
@@ -43,6 +55,9 @@ class Main:
 		self.scleranet = Path(args[2] if len(args) > 2 else kw.get('scleranet', 'ScleraNet.hdf5'))
 		self.resize = kw.get('resize', (480, 360))
 		self.overwrite = kw.get('overwrite', False)
+		self.prepare = kw.get('prepare', False)
+		self.config_jobs = kw.get('config_jobs', 1)
+		self.numba = kw.get('numba', True)
 
 		# Extra keyword arguments
 		self.extra = DotDict(**kw)
@@ -56,8 +71,16 @@ class Main:
 		if not self.datasets.is_dir():
 			raise ValueError(f"{self.datasets} is not a directory.")
 
+		if self.prepare:
+			self._prepare_caches()
+			return
+
 		self.threshold = np.linspace(0, 1, self.extra.get('interp', self.extra.get('interp_points', 1000)))
 
+		# Segmentation evaluations are only used to compute the metrics (not to accumulate them), so they can be shared by all samples and threads
+		self._pred_eval = BinaryIntensitySegmentationEvaluation()
+		self._bin_eval = BinarySegmentationEvaluation()
+
 		# Load recognition models
 		self.rec_models = {
 			#"ScleraNet": KerasModel(self.scleranet)} | {
@@ -99,104 +122,242 @@ class Main:
 			# REQUIRES PYTHON>=3.9 self._evaluate_recognition(images[name], greyscales[name], gts[name], save_f.with_stem('Recognition'))
 			self._evaluate_recognition(images[name], greyscales[name], gts[name], save_f.with_name('Recognition.pkl'))
 
-		models = list(self.models.iterdir())
-		with tqdm(models, desc="Evaluating models") as tqdm_models:
-			for self._model in tqdm_models:
-				tqdm_models.set_postfix(model=self._model.name)
-				tqdm_models_leave = self._model == models[-1]
-
-				tt_configs = list(it.product(TRAIN_DATASETS, TEST_DATASETS))
-				with tqdm(tt_configs, desc="On train/test configuration", leave=tqdm_models_leave) as tqdm_data:
-					for self._train, self._test in tqdm_data:
-						tqdm_data.set_postfix(train=self._train, test=self._test)
-						tqdm_data_leave = tqdm_models_leave and (self._train, self._test) == tt_configs[-1]
-
-						self._predictions = self._model/self._train/self._test/'Predictions'
-						self._binarised = self._model/self._train/self._test/'Binarised'
-						seg_save = self._model/f'Pickles/Segmentation/{self._train}_{self._test}.pkl'
-						rec_save = self._model/f'Pickles/Recognition/{self._train}_{self._test}.pkl'
-
-						# Check if both pickles already exist
-						if not self.overwrite and seg_save.is_file() and rec_save.is_file():
-							continue
-
-						# Make sure the necessary directories exist
-						if not self._predictions.is_dir():
-							raise ValueError(f"{self._predictions} is not a directory.")
-						if not self._binarised.is_dir():
-							raise ValueError(f"{self._binarised} is not a directory.")
-
-						with tqdm_joblib(tqdm(datasets[self._test], desc="Reading predictions", leave=tqdm_data_leave)) as data:
-							pred_bin = Parallel(n_jobs=-1)(
-								delayed(self._read_predictions)(gt_sample)
-								for gt_sample in data
-							)
-
-						# This will filter out non-existing predictions, so the code will still work,
-						# but missing predictions should be addressed (otherwise evaluation is unfair)
-						pred_bin_gt = [(*pb, gt) for pb, gt in zip(pred_bin, gts[self._test]) if pb is not None]
-
-						self._evaluate_segmentation(pred_bin_gt, seg_save, tqdm_data_leave)
-						self._evaluate_recognition(images[self._test], greyscales[self._test], lmap(op.itemgetter(1), pred_bin_gt), rec_save, tqdm_data_leave)
-
-	def _open_img(self, f, convert=None):
+		# Every (model, train, test) configuration is independent, so several of them can be evaluated at once.
+		# Each one gets an equal share of the CPUs for its inner parallelisation, to avoid oversubscription.
+		configs = [
+			(model, train, test)
+			for model in self.models.iterdir()
+			for train, test in it.product(TRAIN_DATASETS, TEST_DATASETS)
+		]
+		config_jobs = self.config_jobs if self.config_jobs > 0 else os.cpu_count()  # Non-positive values mean all CPUs (as in joblib)
+		inner_jobs = max(1, os.cpu_count() // config_jobs)
+		with ThreadPoolExecutor(config_jobs) as pool:
+			futures = [
+				pool.submit(self._evaluate_config, model, train, test, datasets[test], images[test], greyscales[test], gts[test], inner_jobs)
+				for model, train, test in configs
+			]
+			try:
+				for future in tqdm(as_completed(futures), total=len(futures), desc="Evaluating model configurations"):
+					future.result()  # Re-raise any exceptions from the configuration
+			except BaseException:
+				# Don't start the remaining configurations (the executor would otherwise wait for all of them before re-raising)
+				for future in futures:
+					future.cancel()
+				raise
+
+	def _evaluate_config(self, model, train, test, samples, images, greyscales, gts, n_jobs):
+		seg_save = model/f'Pickles/Segmentation/{train}_{test}.pkl'
+		rec_save = model/f'Pickles/Recognition/{train}_{test}.pkl'
+
+		# Check if both pickles already exist
+		if not self.overwrite and seg_save.is_file() and rec_save.is_file():
+			return
+
+		# Make sure the necessary directories exist
+		predictions = model/train/test/'Predictions'
+		binarised = model/train/test/'Binarised'
+		if not predictions.is_dir():
+			raise ValueError(f"{predictions} is not a directory.")
+		if not binarised.is_dir():
+			raise ValueError(f"{binarised} is not a directory.")
+
+		# Scan the directories once instead of checking for each sample's files separately
+		predictions = ImageIndex(predictions)
+		binarised = ImageIndex(binarised)
+
+		# Predictions are kept in a disk-backed buffer, so RAM usage doesn't grow with the size of the dataset.
+		# The buffer is a named file, so joblib passes the binarised masks to worker processes by reference instead of pickling them.
+		with tempfile.TemporaryDirectory(prefix='tmp_mmap_', dir=model) as tmp_dir:
+			# Predictions are read ahead in background threads and segmentation metrics are computed while the rest are still being read
+			desc = f"Reading predictions and computing segmentation metrics for {model.name} ({train} - {test})"
+			# The progress bar wraps the output of the read-ahead, so it only advances when a sample is actually consumed
+			read = _read_ahead(partial(self._read_predictions, test, predictions, binarised), samples, n_jobs)
+			with tqdm(read, total=len(samples), desc=desc, leave=False) as data:
+				# This will filter out non-existing predictions, so the code will still work,
+				# but missing predictions should be addressed (otherwise evaluation is unfair)
+				pred_bin_gt = ((*pb, gt) for pb, gt in zip(data, gts) if pb is not None)
+				pred_bin_gt = _memmap_buffered(pred_bin_gt, len(samples), Path(tmp_dir))
+				pred_bin_gt = self._evaluate_segmentation(pred_bin_gt, seg_save, model/'Cache', n_jobs)
+
+			self._evaluate_recognition(images, greyscales, lmap(op.itemgetter(1), pred_bin_gt), rec_save, False, n_jobs)
+			del pred_bin_gt  # Release the views into the buffer before it's deleted (open memmaps can't be deleted on Windows)
+
+	def _prepare_caches(self):
+		""" Decode, resize and cache all GT masks and predictions, so the evaluation itself only has to load the caches. """
+		jobs = [
+			(self._load_mask, Path(sample.mask))
+			for name, dataset in TEST_DATASETS.items()
+			for sample in dataset.from_dir(self.datasets/name/'Images', mask_dir=True, use_img_regex_for_masks=True)
+		] + [
+			(load, f)
+			for model in self.models.iterdir()
+			for train, test in it.product(TRAIN_DATASETS, TEST_DATASETS)
+			for load, dir in ((self._load_intensity, model/train/test/'Predictions'), (self._load_mask, model/train/test/'Binarised'))
+			if dir.is_dir()
+			for f in dir.rglob('*')
+			if f.suffix.lower() in IMG_EXTS
+		]
+
+		with tqdm_joblib(tqdm(jobs, desc="Preparing caches")) as data:
+			Parallel(n_jobs=-1)(
+				delayed(self._prepare_cache)(load, f)
+				for load, f in data
+			)
+
+	@staticmethod
+	def _prepare_cache(load, f):
+		load(f)  # Don't return the array, so it doesn't have to be sent back from the worker process
+
+	def _open_img(self, f, convert=None, resample=Image.BICUBIC):
 		img = Image.open(f)
-		if convert:
+		if convert and img.mode != convert:
 			img = img.convert(convert)
-		if self.resize:
-			img = img.resize(self.resize)
+		if self.resize and img.size != tuple(self.resize):
+			img = img.resize(self.resize, resample)
 		return img
 
 	def _read_img_and_gt(self, sample):
 		img = self._open_img(sample.f, 'RGB')
 		return (
-			np.array(img) / 255,
-			np.array(img.convert('L'), dtype=np.uint8),
-			np.array(self._open_img(sample.mask, '1'), dtype=np.bool_)
+			np.asarray(img) / 255,
+			np.asarray(img.convert('L')),
+			self._load_mask(Path(sample.mask))
 		)
 
-	def _read_predictions(self, sample):
-		pred_f = self._predictions/sample.f.relative_to(self.datasets/self._test/'Images')
-		bin_f = self._binarised/sample.f.relative_to(self.datasets/self._test/'Images')
-		if not pred_f.is_file():
-			for ext in '.jpg', '.jpeg', '.png':
-				pred_f = pred_f.with_suffix(ext)
-				if pred_f.is_file():
-					break
-			else:
-				print(f"Missing prediction file {pred_f}.", file=sys.stderr)
-				return None
-		if not bin_f.is_file():
-			for ext in '.jpg', '.jpeg', '.png':
-				bin_f = bin_f.with_suffix(ext)
-				if bin_f.is_file():
-					break
-			else:
-				print(f"Missing binarised file {bin_f}.", file=sys.stderr)
-				return None
+	def _load_mask(self, f):
+		""" Load binary mask `f` as a boolean array. Masks are cached bit-packed in a `.npy` file next to `f`. """
+		w, h = self._size(f)
+		cache = self._cache_file(f, w, h, 'mask')
+		if self._cache_valid(cache):
+			packed = np.load(cache, mmap_mode='r')
+		else:
+			# Threshold in NumPy rather than converting to '1', which would dither the image
+			packed = np.packbits(np.asarray(self._open_img(f, 'L', Image.NEAREST)) > 127, axis=-1)
+			self._save_cache(cache, packed)
+		return np.unpackbits(packed, axis=-1, count=w).view(np.bool_)
+
+	def _load_intensity(self, f):
+		""" Load greyscale image `f` as a `uint8` array. Images are cached in a `.npy` file next to `f`. """
+		w, h = self._size(f)
+		cache = self._cache_file(f, w, h, 'grey')
+		if self._cache_valid(cache):
+			img = np.load(cache, mmap_mode='r')
+		else:
+			img = np.asarray(self._open_img(f, 'L'))
+			self._save_cache(cache, img)
+		return img
 
-		pred = np.array(self._open_img(pred_f, 'L')) / 255
-		bin_ = np.array(self._open_img(bin_f, '1'), dtype=np.bool_)
-		return pred, bin_
+	def _size(self, f):
+		if self.resize:
+			return tuple(self.resize)
+		with Image.open(f) as img:  # Only reads the header
+			return img.size
+
+	@staticmethod
+	def _cache_file(f, w, h, kind):
+		# The cache is named after the image's mtime and file size, so a replaced image never matches a stale cache
+		# (not even when the new image has an older mtime, e.g. when copied with `cp -p` or `rsync -a`)
+		stat = f.stat()
+		return f.with_name(f'{f.name}.{w}x{h}.{stat.st_mtime_ns}-{stat.st_size}.{kind}.npy')
+
+	def _cache_valid(self, cache):
+		return not self.overwrite and cache.is_file()
+
+	@staticmethod
+	def _save_cache(cache, arr):
+		_write_atomically(cache, partial(np.save, arr=arr))
+
+		# Remove caches of previous versions of the image (they differ in the mtime and size part of the name,
+		# and also in the dimensions if images aren't resized and the new image has a different size)
+		name, _, _, kind, ext = cache.name.rsplit('.', 4)
+		for stale in cache.parent.glob(f'{glob.escape(name)}.*.*.{kind}.{ext}'):
+			if stale != cache:
+				try:
+					stale.unlink()
+				except FileNotFoundError:  # Already removed by another worker
+					pass
+
+	@staticmethod
+	def _load_pickle(f):
+		""" Load a cached result from `f`, or return `None` if it doesn't exist or can't be loaded (so it's recomputed). """
+		try:
+			with f.open('rb') as file:
+				return pickle.load(file)
+		except Exception:
+			return None
+
+	def _read_predictions(self, test, predictions, binarised, sample):
+		f = sample.f.relative_to(self.datasets/test/'Images')
+		pred_f = predictions.find(f)
+		bin_f = binarised.find(f)
+		if pred_f is None:
+			print(f"Missing prediction file {predictions.dir/f}.", file=sys.stderr)
+			return None
+		if bin_f is None:
+			print(f"Missing binarised file {binarised.dir/f}.", file=sys.stderr)
+			return None
+
+		return self._load_intensity(pred_f), self._load_mask(bin_f), (pred_f, bin_f, Path(sample.mask))
+
+	def _result_cache(self, cache_dir, files):
+		"""
+		Cache file in `cache_dir` for a sample's segmentation results and the stamp its cached results have to match.
+
+		The file is named after the sample's `files`, so newer results replace older ones instead of piling up.
+		The stamp can only change if one of the `files` (or the image size) does.
+		"""
+
+		key = hashlib.blake2b(repr(lmap(str, files)).encode(), digest_size=16).hexdigest()
+		stamp = [(stat.st_mtime_ns, stat.st_size) for stat in (f.stat() for f in files)] + [self.resize]
+		return cache_dir/f'{key}.pkl', stamp
+
+	def _evaluate_segmentation(self, pred_bin_gt, save_f, cache_dir, n_jobs=None):
+		"""
+		Evaluate the `(pred, bin_, files, gt)` tuples from the iterable `pred_bin_gt` and return their `(pred, bin_, gt)` triplets as a list.
+
+		Each batch of `SEG_BATCH` samples is evaluated in a background thread as soon as it has been read from `pred_bin_gt`.
+		Results of individual samples are cached in `cache_dir` (see `_result_cache`), so unchanged samples don't have to be evaluated again.
+		"""
 
-	def _evaluate_segmentation(self, pred_bin_gt, save_f, leave_pbar=True):
 		if not self.overwrite and save_f.is_file():
-			return
+			return [(pred, bin_, gt) for pred, bin_, _, gt in pred_bin_gt]
 		save_f.parent.mkdir(parents=True, exist_ok=True)
+		cache_dir.mkdir(exist_ok=True)
 
 		# Evaluate predictions against the ground truths
-		with tqdm_joblib(tqdm(pred_bin_gt, desc="Computing segmentation metrics", leave=leave_pbar)) as data:
-			evals_and_plots = Parallel(n_jobs=-1)(
-				delayed(self._segmentation_metrics_for_sample)(pred, bin_, gt)
-				for pred, bin_, gt in data
-			)
+		# Threads are enough here since the work is done in NumPy (which releases the GIL), and they avoid pickling the arrays to worker processes
+		# Samples are batched by size, since they have to be stacked (they can differ when images aren't resized)
+		read, evals_and_plots, batches, futures = [], [], {}, []
+		with ThreadPoolExecutor(n_jobs) as pool:
+			def submit(batch):
+				futures.append((batch, pool.submit(self._segmentation_metrics_for_batch, [read[i] for i, _, _ in batch])))
+
+			for pred, bin_, files, gt in pred_bin_gt:
+				read.append((pred, bin_, gt))
+				cache_f, stamp = self._result_cache(cache_dir, files)
+				cached = self._load_pickle(cache_f) if not self.overwrite else None
+				if isinstance(cached, dict) and cached.get('stamp') == stamp:
+					evals_and_plots.append(cached['result'])
+				else:
+					evals_and_plots.append(None)  # Filled in when the batch is done
+					batch = batches.setdefault(pred.shape, [])
+					batch.append((len(read) - 1, cache_f, stamp))
+					if len(batch) == SEG_BATCH:
+						submit(batches.pop(pred.shape))
+			for batch in batches.values():
+				submit(batch)
+
+			for batch, future in futures:
+				for (i, cache_f, stamp), result in zip(batch, future.result()):
+					evals_and_plots[i] = result
+					_write_atomically(cache_f, partial(pickle.dump, {'stamp': stamp, 'result': result}))
 
 		evals = [{
-			metric: np.array([ep[pb][metric].mean for ep in evals_and_plots])
-			for metric in evals_and_plots[0][pb].keys()
+			metric: np.array([ep[pb][metric] for ep in evals_and_plots])
+			for metric in evals_and_plots[0][pb]
 		} for pb in range(2)]
-		plots = lmap(op.itemgetter(2), evals_and_plots)
-		mean_plot = Plot.mean_and_std(plots, self.threshold)
+		plots = Plot.stack(lmap(op.itemgetter(2), evals_and_plots), self.threshold)
+		mean_plot = Plot.mean_and_std(plots)
 
 		# Save results to pickle file
 		with save_f.open('wb') as f:
@@ -204,80 +365,90 @@ class Main:
 			pickle.dump(plots, f)
 			pickle.dump(mean_plot, f)
 
-	def _segmentation_metrics_for_sample(self, pred, bin_, gt):
-		pred_eval = BinaryIntensitySegmentationEvaluation()
-		bin_eval = BinarySegmentationEvaluation()
-		pred, bin_, gt = pred.flatten(), bin_.flatten(), gt.flatten()
+		return read
 
-		# Edge case
-		if not np.any(pred):
-			pred = pred.copy()
-			pred[0] = .5
-		if not np.any(bin_):
-			bin_ = bin_.copy()
-			bin_[0] = 1
+	def _segmentation_metrics_for_batch(self, pred_bin_gt):
+		pred_eval, bin_eval = self._pred_eval, self._bin_eval
+
+		# Stack the samples into 2D arrays of flattened images, so metrics can be computed for the whole batch at once
+		preds, bins, gts = (np.stack([x.ravel() for x in arrays]) for arrays in zip(*pred_bin_gt))
 
+		# Edge cases
+		preds[~preds.any(1), 0] = GREY_LEVELS // 2
+		bins[~bins.any(1), 0] = True
+
+		# Compute P/R curves of probabilistic predictions from histograms of their grey levels (each grey level is a threshold).
+		# The extra threshold above the maximum yields the (recall=0, precision=1) end point (as in sklearn's precision_recall_curve).
+		confusion_histograms = _confusion_histograms_numba if self.numba and numba else _confusion_histograms
+		pos_hist, neg_hist, bin_tp, bin_fp = confusion_histograms(preds, bins, gts)
+		tp = pos_hist[:, ::-1].cumsum(1)[:, ::-1]
+		fp = neg_hist[:, ::-1].cumsum(1)[:, ::-1]
+		positives = tp[:, 0]  # Everything is predicted positive at the lowest threshold, so this is the number of GT positives
+		bin_fn = positives - bin_tp
 		with np.errstate(invalid='ignore', divide='ignore'):  # Ignore division by zero as it's handled below
-			# Compute P/R curve of probabilistic prediction
-			precisions, recalls, thresholds = skmetrics.precision_recall_curve(gt, pred)
-		thresholds = np.append(thresholds, 1.)
-
-		# Hack for edge cases (delete points with the same recall - this also deletes any points with precision=0, recall=0)
-		recalls[~np.isfinite(recalls)] = 0  # division by zero in above P/R curve should result in 0
-		# Get duplicate indices
-		idx_sort = np.argsort(recalls)
-		sorted_recalls_array = recalls[idx_sort]
-		vals, idx_start, count = np.unique(sorted_recalls_array, return_counts=True, return_index=True)
-		duplicates = list(filter(lambda x: x.size > 1, np.split(idx_sort, idx_start[1:])))
-		if duplicates:
-			# We need to delete everything but the one with maximum precision value
-			for i, duplicate in enumerate(duplicates):
-				duplicates[i] = sorted(duplicate, key=lambda idx: precisions[idx])[:-1]
-			to_delete = np.concatenate(duplicates)
-			recalls = np.delete(recalls, to_delete)
-			precisions = np.delete(precisions, to_delete)
-			thresholds = np.delete(thresholds, to_delete)
-		# Find threshold with the best F1-score and update scores at this index
-		f1scores = 2 * precisions * recalls / (precisions + recalls)
-		idx = f1scores.argmax()
-		pred_eval.f1score.update(f1scores[idx])
-		pred_eval.precision.update(precisions[idx])
-		pred_eval.recall.update(recalls[idx])
-		pred_eval.iou.compute_and_update(gt, pred >= thresholds[idx])
-
-		# Compute AUC
-		pred_eval.auc.compute_and_update(precisions=precisions, recalls=recalls)
-
-		# Binarised prediction
-		for metric in bin_eval:
-			metric.compute_and_update(gt, bin_)
-
-		plot = Plot(
-			recalls,
-			precisions,
-			thresholds,
-			f1scores,
-			(recalls[idx], precisions[idx]),
-			(bin_eval.recall.last(), bin_eval.precision.last())
-		)
+			all_precisions = tp / (tp + fp)
+			all_recalls = tp / positives[:, None]
+		all_precisions[~np.isfinite(all_precisions)] = 1  # no predictions above the threshold
+		all_recalls[~np.isfinite(all_recalls)] = 0  # division by zero in above P/R curve should result in 0
+
+		results = []
+		for i, (precisions, recalls) in enumerate(zip(all_precisions, all_recalls)):
+			# Delete points with the same recall (this also deletes any points with precision=0, recall=0).
+			# Recall doesn't increase with the threshold and precision can only grow while recall stays the same,
+			# so the last point of each run of equal recalls is the one with the maximum precision.
+			keep = np.append(recalls[1:] != recalls[:-1], True)
+			recalls, precisions, levels = recalls[keep], precisions[keep], np.arange(GREY_LEVELS + 1)[keep]
+
+			# Find threshold with the best F1-score and get scores at this index
+			f1scores = 2 * precisions * recalls / (precisions + recalls)
+			idx = f1scores.argmax()
+			level = levels[idx]
+			pred_scores = {
+				pred_eval.iou.name: pred_eval.iou(tp=tp[i, level], fp=fp[i, level], fn=positives[i] - tp[i, level]),
+				pred_eval.f1score.name: f1scores[idx],
+				pred_eval.precision.name: precisions[idx],
+				pred_eval.recall.name: recalls[idx],
+				pred_eval.auc.name: pred_eval.auc(precisions=precisions, recalls=recalls)
+			}
+
+			# Binarised prediction
+			bin_precision = bin_eval.precision(tp=bin_tp[i], fp=bin_fp[i], fn=bin_fn[i])
+			bin_recall = bin_eval.recall(tp=bin_tp[i], fp=bin_fp[i], fn=bin_fn[i])
+			bin_scores = {
+				bin_eval.iou.name: bin_eval.iou(tp=bin_tp[i], fp=bin_fp[i], fn=bin_fn[i]),
+				bin_eval.f1score.name: bin_eval.f1score(precision=bin_precision, recall=bin_recall),
+				bin_eval.precision.name: bin_precision,
+				bin_eval.recall.name: bin_recall
+			}
+
+			plot = Plot(
+				recalls,
+				precisions,
+				levels / (GREY_LEVELS - 1),
+				f1scores,
+				(recalls[idx], precisions[idx]),
+				(bin_recall, bin_precision)
+			)
+
+			results.append((pred_scores, bin_scores, plot))
 
-		return pred_eval, bin_eval, plot
+		return results
 
-	def _evaluate_recognition(self, images, greyscales, masks, save_f, leave_pbar=True):
+	def _evaluate_recognition(self, images, greyscales, masks, save_f, leave_pbar=True, n_jobs=-1):
 		if not self.overwrite and save_f.is_file():
 			return
 		save_f.parent.mkdir(parents=True, exist_ok=True)
 
 		if any(method.accepts_rgb_input for method in self.rec_models.values()):
-			with tqdm_joblib(tqdm(lzip(images, masks), desc="Masking images", leave=leave_pbar)) as data:
-				images = Parallel(n_jobs=-1)(
+			with TQDM_JOBLIB_LOCK, tqdm_joblib(tqdm(lzip(images, masks), desc="Masking images", leave=leave_pbar)) as data:
+				images = Parallel(n_jobs=n_jobs)(
 					delayed(self._mask_and_resize_img)(img, mask)
 					for img, mask in data
 				)
 
 		if any(not method.accepts_rgb_input for method in self.rec_models.values()):
-			with tqdm_joblib(tqdm(lzip(greyscales, masks), desc="Masking greyscale images", leave=leave_pbar)) as data:
-				images = Parallel(n_jobs=-1)(
+			with TQDM_JOBLIB_LOCK, tqdm_joblib(tqdm(lzip(greyscales, masks), desc="Masking greyscale images", leave=leave_pbar)) as data:
+				images = Parallel(n_jobs=n_jobs)(
 					delayed(self._mask_and_resize_img)(img, mask)
 					for img, mask in data
 				)
@@ -307,7 +478,7 @@ class Main:
 	# Can't pickle recognition models so we have to override pickling
 	def __getstate__(self):
 		state = self.__dict__.copy()
-		del state['rec_models']
+		state.pop('rec_models', None)
 		return state
 
 	def process_command_line_options(self):
@@ -318,6 +489,9 @@ class Main:
 		ap.add_argument('scleranet', type=Path, nargs='?', default=self.scleranet, help="path to file with saved ScleraNet weights")
 		ap.add_argument('-r', '--resize', type=int, nargs=2, help="width and height to resize the images to")
 		ap.add_argument('-o', '--overwrite', action='store_true', help="overwrite existing data")
+		ap.add_argument('-j', '--config-jobs', type=int, help="number of model/train/test configurations to evaluate in parallel (values <= 0 use all CPUs)")
+		ap.add_argument('--no-numba', dest='numba', action='store_false', help="don't use the numba kernel for segmentation metrics, even if numba is installed")
+		ap.add_argument('-p', '--prepare', action='store_true', help="only decode, resize and cache the GT masks and predictions, without evaluating them")
 		ap.parse_known_args(namespace=self)
 
 		ap = argparse.ArgumentParser(description="Extra keyword arguments.")
@@ -338,6 +512,27 @@ class Main:
 		return gui.ok
 
 
+class ImageIndex(dict):
+	""" Index of the image files in `dir` (recursively) by their path relative to `dir` without the extension, and then by their extension. """
+
+	def __init__(self, dir):
+		super().__init__()
+		self.dir = Path(dir)
+		for root, _, files in os.walk(self.dir):
+			for name in files:
+				f = Path(root, name)
+				if f.suffix.lower() in IMG_EXTS:  # This also skips any cache files
+					self.setdefault(f.relative_to(self.dir).with_suffix(''), {})[f.suffix] = f
+
+	def find(self, f):
+		""" Find the file corresponding to relative path `f`, preferring the same extension and falling back to common ones. """
+		candidates = self.get(f.with_suffix(''), {})
+		for ext in f.suffix, '.jpg', '.jpeg', '.png':
+			if ext in candidates:
+				return candidates[ext]
+		return None
+
+
 class Plot:
 	def __init__(self, recall, precision, threshold=None, f1=None, f1_point=None, bin_point=None):
 		self.recall = recall
@@ -355,33 +550,45 @@ class Plot:
 			else:
 				self.recall = np.array([0, 1])
 				self.precision = np.array([self.precision[0], 0])
-		
 
-	@classmethod
-	def mean_and_std(cls, plots, interp=1000):
+	def interp(self, recall):
+		""" Linearly interpolate the precision at the given recall values. """
+		order = np.argsort(self.recall)
+		return np.interp(recall, self.recall[order], self.precision[order])
+
+	@staticmethod
+	def stack(plots, interp=1000):
+		"""
+		Stack `plots` into a dict of arrays with one row per plot.
+
+		Precisions are interpolated to the recall values `interp` (or that many evenly spaced ones), so all rows have the same length.
+		"""
+
 		try:
 			iter(interp)
 		except TypeError:
 			interp = np.linspace(0, 1, interp)
 
-		# Interpolate precision to linspace recall for mean computation
-		precision = np.vstack([
-			#interp1d(plot.recall, plot.precision, fill_value='extrapolate')(interp)
-			interp1d(plot.recall, plot.precision)(interp)
-			#interp1d(plot.recall, plot.precision, fill_value=(1, 0))(interp)
-			for plot in plots
-		])
-		bin_points = np.vstack([plot.bin_point for plot in plots])
+		return {
+			'recall': interp,
+			'precision': np.vstack([plot.interp(interp) for plot in plots]),
+			'f1_point': np.vstack([plot.f1_point for plot in plots]),
+			'bin_point': np.vstack([plot.bin_point for plot in plots])
+		}
 
-		# Compute mean graph and standard deviations
-		mean, std = precision.mean(0), precision.std(0)
+	@classmethod
+	def mean_and_std(cls, plots):
+		""" Compute the mean plot and the plots one standard deviation below and above it from `plots` stacked with `Plot.stack`. """
+		interp = plots['recall']
+		mean, std = plots['precision'].mean(0), plots['precision'].std(0)
 
 		# Find max F1 point on mean graph
-		f1 = F()
-		idx = np.array([f1(precision=p, recall=r) for p, r in zip(mean, interp)]).argmax()
+		with np.errstate(invalid='ignore'):
+			f1 = 2 * mean * interp / (mean + interp)
+		idx = np.nan_to_num(f1).argmax()  # F1 is 0 where both precision and recall are 0
 
 		return (
-			Plot(interp, mean, f1_point=(interp[idx], mean[idx]), bin_point=bin_points.mean(0)),  # mean
+			Plot(interp, mean, f1_point=(interp[idx], mean[idx]), bin_point=plots['bin_point'].mean(0)),  # mean
 			Plot(interp, mean - std),  # lower std
 			Plot(interp, mean + std)   # upper std
 		)
@@ -443,6 +650,10 @@ class GUI(Tk):
 		self.overwrite_var.set(self.args.overwrite)
 		self.overwrite_chk = Checkbutton(self.chk_frame, text="Overwrite", variable = self.overwrite_var)
 		self.overwrite_chk.grid(sticky='w')
+		self.prepare_var = BooleanVar()
+		self.prepare_var.set(self.args.prepare)
+		self.prepare_chk = Checkbutton(self.chk_frame, text="Only prepare caches", variable = self.prepare_var)
+		self.prepare_chk.grid(sticky='w')
 
 		row += 1
 		self.extra_frame = ExtraFrame(self.frame)
@@ -491,6 +702,7 @@ class GUI(Tk):
 		# REQUIRES PYTHON>=3.8 self.args.resize = (int(w), int(h)) if (w := self.width_txt.get()) and (h := self.height_txt.get()) else None
 		self.args.resize = (int(self.width_txt.get()), int(self.height_txt.get())) if self.width_txt.get() and self.height_txt.get() else None
 		self.args.overwrite = self.overwrite_var.get()
+		self.args.prepare = self.prepare_var.get()
 
 		for kw in self.extra_frame.pairs:
 			key, value = kw.key_txt.get(), kw.value_txt.get()
@@ -553,6 +765,90 @@ class KWFrame(Frame):
 		self.destroy()
 
 
+def _confusion_histograms(preds, bins, gts):
+	"""
+	Compute the confusion histograms of a batch of flattened images.
+
+	Returns histograms of the grey levels in `preds` over the GT positives and over the GT negatives (one row of
+	`GREY_LEVELS + 1` bins per sample), and the TP and FP counts of the binarised predictions `bins` for each sample.
+	"""
+
+	n = len(preds)
+	negatives = ~gts  # Computed once and shared by all the counts below
+	# The histograms of all samples are computed with a single bincount by giving each sample its own range of bins
+	keys = preds + np.arange(0, n * (GREY_LEVELS + 1), GREY_LEVELS + 1, dtype=np.int32)[:, None]
+	pos_hist = np.bincount(keys[gts], minlength=n * (GREY_LEVELS + 1)).reshape(n, -1)
+	neg_hist = np.bincount(keys[negatives], minlength=n * (GREY_LEVELS + 1)).reshape(n, -1)
+	bin_tp = np.count_nonzero(bins & gts, 1)
+	bin_fp = np.count_nonzero(bins & negatives, 1)
+	return pos_hist, neg_hist, bin_tp, bin_fp
+
+
+if numba:
+	# Batches are already processed in parallel threads, so this releases the GIL rather than using numba's own parallelisation
+	@numba.njit(nogil=True, cache=True)
+	def _confusion_histograms_numba(preds, bins, gts):
+		""" Same as `_confusion_histograms`, but computed in a single pass over the pixels without any temporary arrays. """
+		n, size = preds.shape
+		pos_hist = np.zeros((n, GREY_LEVELS + 1), np.int64)
+		neg_hist = np.zeros((n, GREY_LEVELS + 1), np.int64)
+		bin_tp = np.zeros(n, np.int64)
+		bin_fp = np.zeros(n, np.int64)
+		for i in range(n):
+			for j in range(size):
+				if gts[i, j]:
+					pos_hist[i, preds[i, j]] += 1
+					bin_tp[i] += bins[i, j]
+				else:
+					neg_hist[i, preds[i, j]] += 1
+					bin_fp[i] += bins[i, j]
+		return pos_hist, neg_hist, bin_tp, bin_fp
+
+
+def _write_atomically(f, write):
+	""" Call `write` on a temporary file and move it to `f` afterwards, so an interrupted run can't leave behind a truncated `f`. """
+	tmp = f.with_name(f'{f.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+	with tmp.open('wb') as file:
+		write(file)
+	tmp.replace(f)
+
+
+def _read_ahead(f, items, n_jobs=None):
+	""" Lazily map `f` over `items` in background threads, keeping up to `2 * n_jobs` items in flight ahead of the consumer. """
+	n_jobs = n_jobs or os.cpu_count()
+	with ThreadPoolExecutor(n_jobs) as pool:
+		pending = deque()
+		for item in items:
+			pending.append(pool.submit(f, item))
+			if len(pending) >= 2 * n_jobs:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+
+def _memmap_buffered(pred_bin_gt, n, dir):
+	"""
+	Copy the predictions and binarised masks of (at most `n`) `(pred, bin_, files, gt)` tuples into memory-mapped buffers in directory `dir`.
+
+	Yields the same tuples, but with `pred` and `bin_` replaced by views into the buffers, which the OS can page out as needed.
+	"""
+
+	# Samples can differ in size (if images aren't resized), so each one is stored at its own offset in a flat buffer.
+	# The buffer is sized from the first sample; if a larger sample doesn't fit, a new buffer is started for the rest.
+	# The files are sparse, so space reserved for samples that are never read isn't actually allocated.
+	buffer, offset = None, 0
+	for i, (pred, bin_, files, gt) in enumerate(pred_bin_gt):
+		size = pred.size + bin_.size
+		if buffer is None or offset + size > buffer.size:
+			buffer = np.memmap(dir/f'predictions{i}.mmap', dtype=np.uint8, mode='w+', shape=((n - i) * size,))
+			offset = 0
+		row = buffer[offset:offset+size]
+		offset += size
+		row[:pred.size] = pred.ravel()
+		row[pred.size:] = bin_.ravel()
+		yield row[:pred.size].reshape(pred.shape), row[pred.size:].view(np.bool_).reshape(bin_.shape), files, gt
+
+
 def _set_entry_text(entry, txt):
 	entry.delete(0, END)
 	entry.insert(END, txt)
@@ -10,7 +10,7 @@ class BinarySegmentationEvaluation(Evaluation):
 
 
 class BinaryIntensitySegmentationEvaluation(BinarySegmentationEvaluation):
-	#TODO: For EyeZ probably some of the code from compute._segmentation_metrics_for_sample could be moved here (similar to VerificationMetric.error_rates_from_dist_matrix)
+	#TODO: For EyeZ probably some of the code from compute._segmentation_metrics_for_batch could be moved here (similar to VerificationMetric.error_rates_from_dist_matrix)
 	def __init__(self, *args, **kw):
 		super().__init__(AUC(**kw), *args)
 
@@ -20,8 +20,13 @@ class IoU(Metric):
 		super().__init__(*args, **kw)
 		self.average = average
 
-	def __call__(self, gt, predictions):
-		return skmetrics.jaccard_score(gt, predictions, average=self.average, zero_division=0)
+	def __call__(self, gt=None, predictions=None, *, tp=None, fp=None, fn=None):
+		if tp is not None and fp is not None and fn is not None:
+			if self.average != 'binary':
+				raise ValueError(f"Computing IoU from confusion counts is only supported with average='binary', not '{self.average}'.")
+			return tp / (tp + fp + fn) if tp + fp + fn else 0
+		else:
+			return skmetrics.jaccard_score(gt, predictions, average=self.average, zero_division=0)
 
 
 class F(Metric):
@@ -41,13 +46,19 @@ class F(Metric):
 
 
 class Precision(Metric):
-	def __call__(self, *args, **kw):
-		return skmetrics.precision_score(*args, zero_division=0, **kw)
+	def __call__(self, *args, tp=None, fp=None, fn=None, **kw):
+		if tp is not None and fp is not None:
+			return tp / (tp + fp) if tp + fp else 0
+		else:
+			return skmetrics.precision_score(*args, zero_division=0, **kw)
 
 
 class Recall(Metric):
-	def __call__(self, *args, **kw):
-		return skmetrics.recall_score(*args, zero_division=0, **kw)
+	def __call__(self, *args, tp=None, fp=None, fn=None, **kw):
+		if tp is not None and fn is not None:
+			return tp / (tp + fn) if tp + fn else 0
+		else:
+			return skmetrics.recall_score(*args, zero_division=0, **kw)
 
 
 class AUC(Metric):